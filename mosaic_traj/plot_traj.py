@@ -21,12 +21,15 @@ import sys
 import datetime as dt
 import argparse
 import math
+import functools
 
 # third party imports
+import numpy as np
 import pandas as pd
 import matplotlib
-matplotlib.use('Agg')  # use Agg backend for matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
@@ -62,6 +65,15 @@ def parse_args():
     parser.add_argument('--days', type=int, default=5,
                         help='''Number of days over which to plot trajectories''')
 
+    parser.add_argument('--fast', action='store_true',
+                        help='''Plot on a PlateCarree map rather than a polar
+                        Orthographic projection, which is quicker to draw''')
+
+    parser.add_argument('--cache', action='store_true',
+                        help='''Cache trajectory data as Parquet alongside the
+                        trajectory files for faster subsequent reads
+                        (requires pyarrow or fastparquet)''')
+
     pa = parser.parse_args()
 
     # Check if path exists
@@ -82,25 +94,146 @@ def parse_args():
     return pa
 
 
-def plot_traj(path, out_dir, track_file=None, start_date=None, end_date=None, freq=15, days=5):
+@functools.lru_cache(maxsize=None)
+def natural_earth(category, name, scale='110m'):
+    """Get Natural Earth geometries, reading the shapefile once per session"""
+    feature = cfeature.NaturalEarthFeature(category, name, scale)
+    return tuple(feature.geometries())
+
+
+def traj_segments(data, dt_index, traj_hours):
+    """Get (lon, lat) segment for each trajectory released at dt_index
+
+    Each segment runs from the first point where P is positive
+    up to the first point where P < 980 or the trajectory is older
+    than traj_hours, whichever comes first.
+    """
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index()
+
+    p = data['P (MB)'].to_numpy()
+    hours = data['HOURS'].to_numpy()
+    n = len(p)
+
+    # Row offsets of the start and end of each trajectory, skipping
+    # release times that are not available
+    reads = data.index.get_level_values(0).to_numpy()
+    starts = np.searchsorted(reads, dt_index.to_numpy(), side='left')
+    ends = np.searchsorted(reads, dt_index.to_numpy(), side='right')
+    keep = starts < ends
+    starts, ends = starts[keep], ends[keep]
+    bounds = np.column_stack([starts, ends]).ravel()
+
+    # Position of the first True value in each trajectory, or n if
+    # there is none. Reducing over (start, end) pairs means only the
+    # requested trajectories are examined
+    pos = np.arange(n + 1)
+
+    def first(mask):
+        pos_mask = np.where(np.append(mask, False), pos, n)
+        return np.minimum.reduceat(pos_mask, bounds)[::2]
+
+    # End at the first point where P < 980 or the trajectory is too
+    # old, in a single pass over both conditions
+    valid = p > 0
+    ind0 = first(valid)
+    ind1 = first((valid & (p < 980)) | (hours < -traj_hours))
+    ind1 = np.minimum(ind1, ends - 1)
+    keep = ind0 < ends
+
+    lon = (data['LON'].to_numpy() + 180) % 360 - 180
+    xy = np.column_stack([lon, data['LAT'].to_numpy()])
+    return [xy[i0:i1+1] for i0, i1 in zip(ind0[keep], ind1[keep])]
+
+
+def split_antimeridian(segs):
+    """Break (lon, lat) segments where they cross the antimeridian
+
+    A NaN row is inserted at each crossing, so that each trajectory
+    remains a single segment but is not drawn across the map.
+    """
+    return [np.insert(x, np.flatnonzero(np.abs(np.diff(x[:, 0])) > 180) + 1,
+                      np.nan, axis=0)
+            for x in segs]
+
+
+def project_points(lon, lat, projection):
+    """Transform lon, lat arrays to (N, 2) projection coordinates"""
+    return projection.transform_points(ccrs.PlateCarree(), lon, lat)[:, :2]
+
+
+def project_segments(segs, projection):
+    """Transform (lon, lat) segments to projection coordinates"""
+    if len(segs) == 0:
+        return segs
+
+    lonlat = np.concatenate(segs)
+    xy = project_points(lonlat[:, 0], lonlat[:, 1], projection)
+    return np.split(xy, np.cumsum([len(x) for x in segs])[:-1])
 
-    plot_data = []
+
+def load_data(path, start_date=None, end_date=None, cache=False):
+    """Read trajectory data as a list of (data, metadata) tuples"""
     if start_date is not None:
-        plot_data = read_data(path, start_date, end_date)
+        return read_data(path, start_date, end_date, cache=cache)
+    return [read_traj(path, cache=cache)]
+
+
+# Keep the most recently loaded data in memory, for callers that plot
+# the same data repeatedly within one process
+_load_cached = functools.lru_cache(maxsize=4)(load_data)
+
+
+def read_track(track_file):
+    track_data = pd.read_csv(track_file, index_col='timestamp')
+    track_data.columns = [x.lower() for x in track_data.columns]
+    return track_data
+
+
+def plot_traj(path, out_dir, track_file=None, start_date=None, end_date=None, freq=15, days=5,
+              fast=False, cache=False, memoize=False):
+
+    if memoize:
+        plot_data = _load_cached(path, start_date, end_date, cache)
+    else:
+        plot_data = load_data(path, start_date, end_date, cache)
+
+    track_data = None
+    if track_file is not None:
+        track_data = read_track(track_file)
+
+    return build_figure(plot_data, track_data, out_dir,
+                        freq=freq, days=days, fast=fast)
+
+
+def build_figure(plot_data, track_data=None, out_dir=None, freq=15, days=5, fast=False):
+    """Plot trajectories from a list of (data, metadata) tuples
+
+    Returns the name of the plot file written.
+    """
+    if fast:
+        projection = ccrs.PlateCarree()
     else:
-        plot_data.append(read_traj(path))
+        projection = ccrs.Orthographic(0, 90)
 
     fig, ax = plt.subplots(figsize=(9,9),
-                           subplot_kw=dict(projection=ccrs.Orthographic(0, 90)))
-    ax.coastlines(zorder=3)
-    ax.add_feature(cfeature.LAND)
-    ax.add_feature(cfeature.OCEAN)
+                           subplot_kw=dict(projection=projection))
+    # Colour the background as water rather than adding the (large)
+    # ocean polygons
+    ax.set_facecolor(cfeature.COLORS['water'])
+    ax.add_geometries(natural_earth('physical', 'land'), ccrs.PlateCarree(),
+                      facecolor=cfeature.COLORS['land'], edgecolor='none',
+                      zorder=-1)
+    ax.add_geometries(natural_earth('physical', 'coastline'), ccrs.PlateCarree(),
+                      facecolor='none', edgecolor='black', zorder=3)
     ax.gridlines()
 
     nday = len(plot_data)
     depth = 4
-    alpha = [math.exp(-x*depth/nday) for x in reversed(range(nday))]
+    alpha = np.exp(-np.arange(nday-1, -1, -1)*depth/nday)
     traj_hours = days*24
+    segs = []
+    nsegs = []
     dates = []
     traj_dt = None
     for i, (data, metadata) in enumerate(plot_data):
@@ -109,47 +242,48 @@ def plot_traj(path, out_dir, track_file=None, start_date=None, end_date=None, fr
         if i == 0:
             dates.append(traj_dt.strftime('%Y%m%d'))
 
-        periods = math.floor(len(data.groupby(level=0))/freq)
+        periods = math.floor(data.index.get_level_values(0).nunique()/freq)
         dt_index = pd.date_range(traj_dt.strftime('%Y%m%d'),
                                  periods=periods, freq=str(freq)+"min")
 
-        for ts in dt_index:
-            try:
-                traj = data.loc[ts]
-            except KeyError:
-                # timestamp not available
-                continue
-
-            # Get subset of data where P is non-negative and P > 980
-            # and length of trajectory is less than specified number
-            # of days
-            ind0 = traj[traj['P (MB)'] > 0].index[0]
-            ind1 = traj[traj['HOURS'] < -traj_hours].index[0]
-            out_of_range = traj[(traj['P (MB)'] > 0) & (traj['P (MB)'] < 980)]
-            if len(out_of_range) > 0:
-                ind1 = min(ind1, out_of_range.index[0])
-
-            # Plot trajectory between these points
-            traj = traj.loc[ind0:ind1]
-            plt.plot((traj.LON + 180) % 360 - 180, traj.LAT,
-                     color='purple', alpha=alpha[i],
-                     transform=ccrs.PlateCarree(),
-                     )
+        traj_segs = traj_segments(data, dt_index, traj_hours)
+        segs.extend(traj_segs)
+        nsegs.append(len(traj_segs))
 
     if i > 0:
         dates.append(traj_dt.strftime('%Y%m%d'))
 
-    if track_file is not None:
-        track_data = pd.read_csv(track_file, index_col='timestamp')
-        track_data.columns = [x.lower() for x in track_data.columns]
-        track_sub = track_data[::60]
-        plt.plot(track_sub.longitude, track_sub.latitude,
-                 color='black', alpha=1.0, linewidth=0, marker='o', markersize=1,
-                 transform=ccrs.PlateCarree(),
-                 )
+    # Plot all trajectories as a single collection, projecting
+    # the coordinates in bulk rather than per artist
+    if fast:
+        segs = split_antimeridian(segs)
+    else:
+        segs = project_segments(segs, ax.projection)
+    colors = np.tile(to_rgba('purple'), (len(segs), 1))
+    colors[:, 3] = np.repeat(alpha, nsegs)
+    lc = LineCollection(segs, colors=colors,
+                        capstyle='projecting', joinstyle='round')
+    # Rasterize the (dense) trajectories when saving to vector formats
+    lc.set_rasterized(True)
+    ax.add_collection(lc)
+
+    if track_data is not None:
+        lon = track_data['longitude'].to_numpy()[::60]
+        lat = track_data['latitude'].to_numpy()[::60]
+        if fast:
+            xy = np.column_stack([(lon + 180) % 360 - 180, lat])
+        else:
+            xy = project_points(lon, lat, ax.projection)
+        # Points are already in map coordinates, so bypass cartopy's
+        # default projection transform
+        ax.scatter(xy[:, 0], xy[:, 1], s=1, c='black', zorder=4,
+                   transform=ax.transData)
 
     # Set map extent
     ax.set_extent([-180, 180, 60, 90], ccrs.PlateCarree())
+    if fast:
+        # Scale longitude by the cosine of the mid-latitude
+        ax.set_aspect(1.0/np.cos(np.deg2rad(75)))
 
     title = ' to '.join(dates)
     plt.title(title)
@@ -161,9 +295,12 @@ def plot_traj(path, out_dir, track_file=None, start_date=None, end_date=None, fr
     plt.savefig(file_name)
     plt.close()
 
+    return file_name
+
 
 def main():
 
+    matplotlib.use('Agg')  # use Agg backend for matplotlib
     args = parse_args()
     plot_traj(args.path,
               out_dir=args.out,
@@ -171,7 +308,9 @@ def main():
               start_date=args.start,
               end_date=args.end,
               freq=args.freq,
-              days=args.days)
+              days=args.days,
+              fast=args.fast,
+              cache=args.cache)
 
 
 if __name__ == '__main__':
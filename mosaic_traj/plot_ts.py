@@ -23,9 +23,9 @@ import argparse
 import math
 
 # third party imports
+import numpy as np
 import pandas as pd
 import matplotlib
-matplotlib.use('Agg')  # use Agg backend for matplotlib
 import matplotlib.pyplot as plt
 
 # local imports
@@ -54,6 +54,11 @@ def parse_args():
     parser.add_argument('--attr', type=str, default=None,
                         help='''Attribute to be plotted''')
 
+    parser.add_argument('--cache', action='store_true',
+                        help='''Cache trajectory data as Parquet alongside the
+                        trajectory files for faster subsequent reads
+                        (requires pyarrow or fastparquet)''')
+
     pa = parser.parse_args()
 
     # Check if file exists
@@ -69,13 +74,28 @@ def parse_args():
     return pa
 
 
-def plot_ts(path, out_dir=None, start_date=None, end_date=None, attr=None):
+def traj_mean(data, columns):
+    """Average columns over each trajectory, i.e. level 0 of the index"""
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index()
+
+    reads = data.index.get_level_values(0)
+    starts = np.flatnonzero(np.append(True, reads[1:] != reads[:-1]))
+    counts = np.diff(np.append(starts, len(reads)))
+
+    values = data[columns].to_numpy()
+    sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+    return pd.DataFrame(sums/counts[:, np.newaxis],
+                        index=reads[starts], columns=columns)
+
+
+def plot_ts(path, out_dir=None, start_date=None, end_date=None, attr=None, cache=False):
 
     traj_data = []
     if start_date is not None:
-        traj_data = read_data(path, start_date, end_date)
+        traj_data = read_data(path, start_date, end_date, cache=cache)
     else:
-        data, metadata = read_traj(path)
+        data, metadata = read_traj(path, cache=cache)
         traj_data.append((data, metadata))
 
     nattr = traj_data[0][1]['number of attributes']
@@ -103,7 +123,7 @@ def plot_ts(path, out_dir=None, start_date=None, end_date=None, attr=None):
     plot_data = [x[0] for x in traj_data]
     plot_data = pd.concat(plot_data)
 
-    summary = plot_data.groupby(level=0).mean()
+    summary = traj_mean(plot_data, attr_names)
 
     summary[attr_names].plot(ax=ax, subplots=True, rot=45)
 
@@ -126,8 +146,9 @@ def plot_ts(path, out_dir=None, start_date=None, end_date=None, attr=None):
 
 
 def main():
+    matplotlib.use('Agg')  # use Agg backend for matplotlib
     args = parse_args()
-    plot_ts(args.path, args.out, args.start, args.end, args.attr)
+    plot_ts(args.path, args.out, args.start, args.end, args.attr, args.cache)
 
 
 if __name__ == '__main__':
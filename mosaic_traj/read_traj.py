@@ -25,8 +25,13 @@ import datetime as dt
 import argparse
 import re
 import glob
+import json
+import functools
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 # third party imports
+import numpy as np
 import pandas as pd
 
 
@@ -38,6 +43,13 @@ ATTR = {
     159: 'boundary layer height (m)'
 }
 
+# Patterns used to parse trajectory metadata
+_DATE_RE = re.compile(r'\d{10}')
+_NUM_RE = re.compile(r'\d+')
+_BOOL_RE = re.compile(r':\s*')
+# Metadata label, i.e. the text preceding IS, = or ?
+_KEY_RE = re.compile(r'\s*(.*?)\s+(?:is|=|\?)(?:\s|$)')
+
 
 def parse_args():
     formatter = argparse.RawDescriptionHelpFormatter
@@ -59,9 +71,10 @@ def parse_args():
     return (pa.file)
 
 
-def process_metadata(file):
+def process_metadata(f):
     '''
-    Process trajectory metadata of the form
+    Process trajectory metadata from open file f, leaving f positioned
+    after the first trajectory header. Metadata is of the form
 
      TRAJECTORY BASE TIME IS 2019092200
      DATA BASE TIME IS 2021051700
@@ -81,13 +94,13 @@ def process_metadata(file):
 
 '''
     def get_date(line):
-        m = re.search('\d{10}', line)
+        m = _DATE_RE.search(line)
         if m is not None:
             return m[0]
 
 
     def get_numeric(line, type='int'):
-        m = re.findall('\d+', line)
+        m = _NUM_RE.findall(line)
         if m is not None:
             if type == 'int':
                 m = [int(x) for x in m]
@@ -100,116 +113,132 @@ def process_metadata(file):
 
 
     def get_boolean(line):
-        m = re.split(':\s*', line)
+        m = _BOOL_RE.split(line)
         if m is not None:
             m = True if m[-1] == 't' else False
         return m
 
 
+    # Single valued metadata, by label
+    parsers = {
+        'trajectory base time': get_date,
+        'data base time': get_date,
+        'total number of trajectories': get_numeric,
+        'number of attributes': get_numeric,
+        'number of clusters': get_numeric,
+        '3d trajectory': get_boolean,
+        'forecast data': get_boolean,
+        'forward trajectory': get_boolean,
+    }
+
     metadata = {}
-    count = 0
-    with open(file) as f:
-        for i, line in enumerate(f):
-            line = line.lower().rstrip('\n')
-            if 'trajectory number' in line:
-                count = count + i
-                break
-            elif 'trajectory base time' in line:
-                metadata['trajectory base time'] = get_date(line)
-            elif 'data base time' in line:
-                metadata['data base time'] = get_date(line)
-            elif 'data interval' in line:
-                # extract data interval and number of timesteps per interval
-                vals = get_numeric(line)
-                if len(vals) == 2:
-                    metadata['data interval hours'] = vals[0]
-                    metadata['data interval timesteps'] = vals[1]
-                else:
-                    raise ValueError(
-                        "Unexpected number of values in data interval"
-                    )
-            elif 'total number of trajectories' in line:
-                # extract number of trajectories
-                metadata['total number of trajectories'] = get_numeric(line)
-            elif 'number of attributes' in line:
-                # extract number of attributes
-                metadata['number of attributes'] = get_numeric(line)
-            elif 'attribute types' in line:
-                # get next line, extract attributes
-                metadata['attribute types'] = get_numeric(next(f))
-                count = count + 1
-            elif 'number of clusters' in line:
-                # extract number of clusters
-                metadata['number of clusters'] = get_numeric(line)
-            elif 'cluster pointers' in line:
-                # get next line, extract cluster pointers
-                metadata['cluster pointers'] = get_numeric(next(f))
-                count = count + 1
-            elif '3d trajectory' in line:
-                # get T/F value
-                metadata['3d trajectory'] = get_boolean(line)
-            elif 'forecast data' in line:
-                # get T/F value
-                metadata['forecast data'] = get_boolean(line)
-            elif 'forward trajectory' in line:
-                # get T/F value
-                metadata['forward trajectory'] = get_boolean(line)
+    for line in f:
+        line = line.lower().rstrip('\n')
+        if 'trajectory number' in line:
+            break
+
+        m = _KEY_RE.match(line)
+        key = m[1] if m is not None else None
+        if key in parsers:
+            metadata[key] = parsers[key](line)
+        elif key == 'data interval':
+            # extract data interval and number of timesteps per interval
+            vals = get_numeric(line)
+            if len(vals) == 2:
+                metadata['data interval hours'] = vals[0]
+                metadata['data interval timesteps'] = vals[1]
             else:
-                # skip
-                pass
-
-    return metadata, count
-
-
-def read_traj(filepath):
-
-    metadata, end = process_metadata(filepath)
-
-    # Assuming filename is of the form rtraj_mosaic_1min_YYYYmmdd00
-    fn = os.path.basename(filepath).split('_')
-    # traj_dt = dt.datetime.strptime(fn[-1], '%Y%m%d00')
-    freq = fn[-2]  # or infer from number of trajectories?
-
-    traj_dt = dt.datetime.strptime(metadata['trajectory base time'], '%Y%m%d%H')
-    npart = metadata['total number of trajectories']
-
-    # TODO get NTS from per trajectory metadata
-    nts = 88
-
-    # TODO get col_names from data
-    metadata['attribute names'] = [ATTR[x] for x in metadata['attribute types']]
-    col_names = ['STEP', 'HOURS', 'LAT', 'LON', 'P (MB)'] + metadata['attribute names']
-
-    index_col = col_names[0]
-    skip_rows = end + 1
-
-    traj_list = [None]*npart
-    with pd.read_csv(filepath,
-                     skiprows=skip_rows,
-                     delim_whitespace=True,
-                     skipinitialspace=True,
-                     header=0,
-                     names=col_names,
-                     index_col=index_col,
-                     iterator=True) as reader:
-        i = 0
-        while i < npart:
-            try:
-                chunk = reader.get_chunk(nts+1)
-                traj_list[i] = chunk
-                reader.get_chunk(2)
-            except StopIteration as e:
-                break
-            i = i+1
-    # Combine reads, indexing by timestamp
+                raise ValueError(
+                    "Unexpected number of values in data interval"
+                )
+        elif key in ('attribute types', 'cluster pointers'):
+            # get next line, extract values
+            metadata[key] = get_numeric(next(f))
+
+    return metadata
+
+
+def read_cache(filepath):
+    '''
+    Read trajectory data and metadata cached alongside filepath, if
+    the cache is newer than filepath. Returns None otherwise.
+    '''
+    cache_file = filepath + '.parquet'
+    metadata_file = filepath + '.json'
+    mtime = os.path.getmtime(filepath)
+    for file in (cache_file, metadata_file):
+        if not os.path.exists(file) or os.path.getmtime(file) < mtime:
+            return None
+
+    df = pd.read_parquet(cache_file)
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    return df, metadata
+
+
+def write_cache(filepath, df, metadata):
+    '''
+    Cache trajectory data as Parquet and metadata as JSON alongside
+    filepath. Failure to write the cache is not an error.
+    '''
+    try:
+        df.to_parquet(filepath + '.parquet', compression='zstd')
+        with open(filepath + '.json', 'w') as f:
+            json.dump(metadata, f)
+    except (OSError, ImportError) as e:
+        warnings.warn("Unable to cache {0}: {1}".format(filepath, e))
+
+
+def read_traj(filepath, cache=False):
+
+    if cache:
+        cached = read_cache(filepath)
+        if cached is not None:
+            return cached
+
+    with open(filepath) as f:
+        metadata = process_metadata(f)
+
+        # Assuming filename is of the form rtraj_mosaic_1min_YYYYmmdd00
+        fn = os.path.basename(filepath).split('_')
+        # traj_dt = dt.datetime.strptime(fn[-1], '%Y%m%d00')
+        freq = fn[-2]  # or infer from number of trajectories?
+
+        traj_dt = dt.datetime.strptime(metadata['trajectory base time'], '%Y%m%d%H')
+        npart = metadata['total number of trajectories']
+
+        # TODO get NTS from per trajectory metadata
+        nts = 88
+
+        # TODO get col_names from data
+        metadata['attribute names'] = [ATTR[x] for x in metadata['attribute types']]
+        col_names = ['STEP', 'HOURS', 'LAT', 'LON', 'P (MB)'] + metadata['attribute names']
+
+        index_col = col_names[0]
+
+        # Read all trajectories from the rest of the file into a single
+        # array in one pass, keeping only the data rows. Single
+        # precision is ample for trajectory data and halves memory use
+        nrows = nts + 1
+        rows = (line for line in f if line.lstrip()[:1].isdigit())
+        values = np.loadtxt(rows, dtype=np.float32, ndmin=2,
+                            max_rows=npart*nrows)
+
+    # Index by release time and step
     ts = dt.datetime.strftime(traj_dt, '%Y-%m-%d')
-    df = pd.concat(traj_list,
-                   keys=pd.date_range(ts, periods=npart, freq=freq),
-                   names=['READ', index_col])
+    reads = pd.date_range(ts, periods=npart, freq=freq)
+    index = pd.MultiIndex.from_arrays(
+        [reads.repeat(nrows)[:len(values)], values[:, 0].astype(int)],
+        names=['READ', index_col])
+    df = pd.DataFrame(values[:, 1:], index=index, columns=col_names[1:])
+
+    if cache:
+        write_cache(filepath, df, metadata)
+
     return df, metadata
 
 
-def read_data(input_dir, start_date, end_date=None):
+def read_data(input_dir, start_date, end_date=None, max_workers=None, cache=False):
 
     if not os.path.isdir(input_dir):
         err_msg = "Not a directory: {0}\n".format(input_dir)
@@ -219,16 +248,20 @@ def read_data(input_dir, start_date, end_date=None):
     if end_date is not None:
         end_date = dt.datetime.fromisoformat(end_date)
 
-    start_dir = os.getcwd()
-    os.chdir(input_dir)
-
-    files = [glob.glob(date.strftime("rtraj*%Y%m%d00"))
+    files = [glob.glob(os.path.join(glob.escape(input_dir), date.strftime("rtraj*%Y%m%d00")))
              for date in daterange(start_date, end_date)]
     files = [filename for elem in files for filename in elem]
 
-    os.chdir(start_dir)
+    reader = functools.partial(read_traj, cache=cache)
+    if len(files) <= 1:
+        return [reader(file) for file in files]
 
-    data = [read_traj(os.path.join(input_dir, file)) for file in files]
+    # Read files concurrently, max_workers defaults to one process per
+    # file, up to the number of processors on the machine
+    if max_workers is None:
+        max_workers = min(len(files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        data = list(ex.map(reader, files))
 
     return data
 